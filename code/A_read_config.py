@@ -1,9 +1,42 @@
 import tomllib
+import sys
 
 import project_logger
 
 logger = project_logger.create_logger('read_config')
 
+# Defaults for options that older config files may not have
+DEFAULTS = {
+    'min_sample_fraction': 1.0,
+    'impute_method': 'mean',
+    'knn_neighbors': 5,
+    'pca_n_top': 10000,
+}
+
+IMPUTE_METHODS = ['mean', 'knn']
+
+def check_config(conf):
+    """Check config options up front, so bad values fail before any work is done"""
+    errors = []
+
+    if not isinstance(conf['min_sample_fraction'], (int, float)) or not 0.0 <= conf['min_sample_fraction'] <= 1.0:
+        errors.append(f'min_sample_fraction must be between 0 and 1, got: {conf["min_sample_fraction"]}')
+
+    if conf['impute_method'] not in IMPUTE_METHODS:
+        errors.append(f'impute_method must be one of {IMPUTE_METHODS}, got: {conf["impute_method"]}')
+
+    for key in ['knn_neighbors', 'pca_n_top']:
+        if not isinstance(conf[key], int) or conf[key] < 1:
+            errors.append(f'{key} must be a positive integer, got: {conf[key]}')
+
+    for error in errors:
+        logger.error(error)
+
+    if len(errors) > 0:
+        sys.exit(1)
+
+    return None
+
 def read_config(cname):
     """Read config TOML file"""
     logger.info(f'Loading config file: {cname}')
@@ -11,6 +44,9 @@ def read_config(cname):
     with open(cname, 'rb') as fh:
         conf = tomllib.load(fh)
 
+    conf = DEFAULTS | conf
+    check_config(conf)
+
     return conf
 
 if __name__ == '__main__':
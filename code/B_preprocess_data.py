@@ -1,14 +1,31 @@
+from functools import partial
 from multiprocessing import Pool
 import glob
 import os
+import sys
+import zlib
 
-from scipy.special import logit
 import pandas as pd
 
 import project_logger
 
 logger = project_logger.create_logger('preprocess_data')
 
+# hg38 chromosome lengths, used to balance chromosome shards
+CHROM_SIZES = {
+    'chr1': 248956422, 'chr2': 242193529, 'chr3': 198295559, 'chr4': 190214555, 'chr5': 181538259,
+    'chr6': 170805979, 'chr7': 159345973, 'chr8': 145138636, 'chr9': 138394717, 'chr10': 133797422,
+    'chr11': 135086622, 'chr12': 133275309, 'chr13': 114364328, 'chr14': 107043718, 'chr15': 101991189,
+    'chr16': 90338345, 'chr17': 83257441, 'chr18': 80373285, 'chr19': 58617616, 'chr20': 64444167,
+    'chr21': 46709983, 'chr22': 50818468, 'chrX': 156040895, 'chrY': 57227415, 'chrM': 16569,
+}
+
+# First line of partial files from sharded runs, followed by the min_sample_fraction used
+PARTIAL_HEADER = '# min_sample_fraction='
+
+# Rows read from a BED file at a time when only keeping some chromosomes
+CHUNK_SIZE = 1000000
+
 def get_sample_name(fname):
     """Extract sample name from file name"""
     base = os.path.basename(fname)
@@ -16,6 +33,9 @@ def get_sample_name(fname):
 
 def beta_to_m_value(betas, covgs, k):
     """Turn CpG beta value into M-value using logit transform"""
+    # scipy is only needed when preprocessing, so defer its import until here
+    from scipy.special import logit
+
     # Easier to retrieve values from lists than from pd.Series
     b = list(betas)
     c = list(covgs)
@@ -32,17 +52,57 @@ def beta_to_m_value(betas, covgs, k):
 
     return pd.Series(out)
 
-def read_file(fname):
-    """Read and preprocess BED file"""
+def assign_chroms(n):
+    """Assign canonical chromosomes to n shards (1 to n), largest first onto the shard with the least sequence"""
+    loads = [0] * n
+    out = {}
+    for chrom, size in sorted(CHROM_SIZES.items(), key=lambda x: x[1], reverse=True):
+        i = loads.index(min(loads))
+        loads[i] += size
+        out[chrom] = i + 1
+
+    return out
+
+def chrom_in_shard(chrom, shard):
+    """Check if chromosome is assigned to shard (k, n), where k runs from 1 to n
+
+    Assignment only depends on the chromosome name, so every node agrees on it without any coordination. Contigs not
+    in CHROM_SIZES fall back to a hash of their name.
+    """
+    k, n = shard
+    if chrom in CHROM_SIZES:
+        return assign_chroms(n)[chrom] == k
+
+    return zlib.crc32(chrom.encode()) % n == k - 1
+
+def read_file(fname, shard=None):
+    """Read and preprocess BED file, optionally only keeping chromosomes in shard (k, n)"""
     samp = get_sample_name(fname)
     logger.info(f'Processing BED file for sample: {samp}')
 
-    df = pd.read_csv(
+    reader = pd.read_csv(
         fname,
         sep='\t',
         names=['chr', 'start', 'end', f'{samp}_raw', 'covg', 'context'],
-        usecols=['chr', 'start', f'{samp}_raw', 'covg']
+        usecols=['chr', 'start', f'{samp}_raw', 'covg'],
+        chunksize=CHUNK_SIZE if shard is not None else None
     )
+
+    if shard is None:
+        df = reader
+    else:
+        # The whole file is still parsed, but other shards' rows are dropped chunk by chunk so they are never held in
+        # memory or run through the M-value calculation
+        keep = {chrom: chrom_in_shard(chrom, shard) for chrom in CHROM_SIZES}
+        chunks = []
+        with reader:
+            for chunk in reader:
+                for chrom in chunk['chr'].unique():
+                    if chrom not in keep:
+                        keep[chrom] = chrom_in_shard(chrom, shard)
+                chunks.append(chunk[chunk['chr'].map(keep)])
+        df = pd.concat(chunks, ignore_index=True)
+
     df[f'{samp}_scaled'] = beta_to_m_value(df[f'{samp}_raw'], df['covg'], 0.1)
 
     # Require minimum coverage of 10 and restrict to canonical chromosomes
@@ -61,36 +121,180 @@ def get_samples_from_metadata(fname):
     logger.info(f'Getting samples from metadata file: {fname}')
     return pd.read_csv(fname, sep='\t', usecols=['WGBS_ID'])
 
-def process_files(dir, n_processes, meta_name):
-    """Pull out files in directory and process them in parallel"""
+def filter_missing(df, min_fraction):
+    """Keep CpGs with data in at least min_fraction of samples, missing values are left as NaN"""
+    raw = df[[col for col in df.columns if '_raw' in col]]
+    n_seen = raw.notna().sum(axis=1)
+
+    # Small tolerance so, e.g., 0.7 of 10 samples requires 7 samples and not 8 from floating point error
+    keep = n_seen >= min_fraction * len(raw.columns) - 1e-9
+    logger.info(f'Keeping {keep.sum()} of {len(df)} CpGs found in at least {min_fraction:.0%} of samples')
+
+    return df[keep]
+
+def join_samples(dfs, min_fraction=1.0):
+    """Join per-sample (or per-shard) DataFrames, keeping CpGs found in at least min_fraction of samples"""
+    logger.info('Merging individual DataFrames')
+    if min_fraction == 1.0:
+        # To address missing data, use only data that is included in all samples
+        return dfs[0].join(dfs[1:], how='inner')
+
+    # Union of all CpGs in a single pass, CpGs missing from a sample are masked as NaN
+    df = pd.concat(dfs, axis=1, join='outer')
+
+    return filter_missing(df, min_fraction)
+
+def process_files(dir, n_processes, meta_name, shard=None, shard_by='sample', min_fraction=1.0):
+    """Pull out files in directory and process them in parallel
+
+    Inputs -
+        dir          - directory holding BED files
+        n_processes  - number of processes to use
+        meta_name    - metadata TSV file (defines which samples we want to keep)
+        shard        - (k, n) tuple to only process shard k of n (1-based), None processes everything
+        shard_by     - 'sample' splits samples in metadata order across shards, 'chr' splits chromosomes
+        min_fraction - keep CpGs found in at least this fraction of samples (1.0 => found in all samples)
+    Returns -
+        DataFrame with CpGs passing the missing data filter, missing values are NaN
+    """
     # Metadata (defines which samples we want to keep)
     meta = get_samples_from_metadata(meta_name)
+    samples = list(meta['WGBS_ID'])
+
+    # Round robin over metadata order, so a node only needs the BED files for its own samples
+    if shard is not None and shard_by == 'sample':
+        k, n = shard
+        logger.info(f'Processing sample shard {k} of {n}')
+        samples = samples[k-1::n]
+
+        # More shards than samples leaves some shards empty, write an empty partial so merge can skip it
+        if len(samples) == 0:
+            logger.warning(f'No samples in metadata are assigned to sample shard {k} of {n}')
+            return pd.DataFrame(index=pd.MultiIndex.from_tuples([], names=['chr', 'start']))
 
     # Not the most efficient way to do this, but it gets the job done
     files = []
-    for f in glob.glob(f'{dir}/*.gz'):
+    for f in sorted(glob.glob(f'{dir}/*.gz')):
         samp = get_sample_name(f)
-        if samp in list(meta['WGBS_ID']):
+        if samp in samples:
             files.append(f)
+        elif shard is not None and shard_by == 'sample' and samp in list(meta['WGBS_ID']):
+            logger.info(f'Ignoring sample assigned to another shard: {samp}')
         else:
             logger.info(f'Ignoring sample name not found in metadata sheet: {samp}')
 
+    if len(files) == 0:
+        logger.error(f'No BED files to process in directory: {dir}')
+        sys.exit(1)
+
+    if shard is not None and shard_by == 'chr':
+        k, n = shard
+        logger.info(f'Processing chromosome shard {k} of {n}')
+        reader = partial(read_file, shard=shard)
+    else:
+        reader = read_file
+
     with Pool(processes=n_processes) as pool:
-        dfs = pool.map(read_file, files)
+        dfs = pool.map(reader, files)
 
-    # To address missing data, use only data that is included in all samples
-    logger.info('Merging individual DataFrames')
-    df = dfs[0].join(dfs[1:], how='inner')
+    # A sample shard only sees some of the samples, so any CpG could still pass the filter once all shards are merged
+    if shard is not None and shard_by == 'sample' and min_fraction < 1.0:
+        logger.info('Deferring missing data filter until partial files are merged')
+        min_fraction = 0.0
 
-    return df
+    return join_samples(dfs, min_fraction)
 
-def main(dir, n_processes, meta_name, oname):
-    """Main preprocessing function"""
-    df = process_files(dir, n_processes, meta_name)
+def read_partial(fname):
+    """Read partial preprocessed file, returning the data and the min_sample_fraction it was created with"""
+    logger.info(f'Reading partial preprocessed file: {fname}')
+
+    with open(fname) as fh:
+        header = fh.readline()
+        if not header.startswith(PARTIAL_HEADER):
+            logger.error(f'Not a partial file from sharded preprocessing (missing header line): {fname}')
+            sys.exit(1)
+
+        try:
+            fraction = float(header[len(PARTIAL_HEADER):])
+        except ValueError:
+            logger.error(f'Not a partial file from sharded preprocessing (malformed header line): {fname}')
+            sys.exit(1)
+
+        df = pd.read_csv(fh, sep='\t', index_col=['chr', 'start'])
+
+    return df, fraction
+
+def merge_partials(fnames, min_fraction=1.0):
+    """Combine partial preprocessed files from sharded runs into the final data
+
+    Partials with the same samples (chromosome shards) are stacked, then partials with different samples (sample
+    shards) are joined, keeping CpGs found in at least min_fraction of samples. Row order may differ from an unsharded
+    run.
+    """
+    groups = {}
+    for fname in fnames:
+        df, fraction = read_partial(fname)
+
+        # Sample shards defer the filter to here, so shards run with a different fraction would bias the merged result
+        if fraction != min_fraction:
+            logger.error(
+                f'Partial file {fname} was created with min_sample_fraction = {fraction}, but merging with '
+                f'{min_fraction} - shards and merge must use the same config'
+            )
+            sys.exit(1)
+
+        # Sample shards with no samples assigned have nothing to add
+        if len(df.columns) == 0:
+            logger.info(f'Skipping partial file with no samples: {fname}')
+            continue
+
+        groups.setdefault(tuple(df.columns), []).append(df)
+
+    if len(groups) == 0:
+        logger.error('None of the partial files have any samples - cannot merge')
+        sys.exit(1)
 
+    dfs = []
+    for dfs_group in groups.values():
+        df = pd.concat(dfs_group)
+        if df.index.has_duplicates:
+            logger.error('Partial files with the same samples share CpGs - was a shard included twice?')
+            sys.exit(1)
+        dfs.append(df)
+
+    columns = [col for df in dfs for col in df.columns]
+    if len(columns) != len(set(columns)):
+        logger.error('Partial files have overlapping, but not identical, samples - cannot merge')
+        sys.exit(1)
+
+    return join_samples(dfs, min_fraction)
+
+def write_data(df, oname, min_fraction=None):
+    """Write preprocessed data if an output file name is given
+
+    Partial files from sharded runs (min_fraction given) start with a header line recording the missing data filter
+    """
     if len(oname) > 0:
         logger.info(f'Creating preprocessed data file: {oname}')
-        df.to_csv(oname, sep='\t')
+        with open(oname, 'w') as fh:
+            if min_fraction is not None:
+                fh.write(f'{PARTIAL_HEADER}{min_fraction}\n')
+            df.to_csv(fh, sep='\t')
+
+    return None
+
+def merge(fnames, oname, min_fraction=1.0):
+    """Main merge function for partial preprocessed files"""
+    df = merge_partials(fnames, min_fraction)
+    write_data(df, oname)
+
+    return df
+
+def main(dir, n_processes, meta_name, oname, shard=None, shard_by='sample', min_fraction=1.0):
+    """Main preprocessing function"""
+    df = process_files(dir, n_processes, meta_name, shard, shard_by, min_fraction)
+
+    write_data(df, oname, min_fraction if shard is not None else None)
 
     return df
 
@@ -12,7 +12,8 @@ def by_sample(df):
     fig = plt.figure(figsize=(10, 5))
     plt.tight_layout()
 
-    bp = plt.boxplot(df, sym='k.')
+    # Drop missing values per sample, otherwise boxplot cannot calculate the statistics
+    bp = plt.boxplot([df[col].dropna() for col in df.columns], sym='k.')
 
     plt.setp(bp['fliers'], markersize=1)
 
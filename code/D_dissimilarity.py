@@ -5,6 +5,7 @@ import pandas as pd
 import numpy as np
 
 import project_logger
+import impute
 
 logger = project_logger.create_logger('dissimilarity')
 
@@ -79,19 +80,18 @@ def plot_dissimilarity(mat, labels):
 
     return None
 
-def main(df):
+def main(df, impute_method='mean', n_neighbors=5):
     """Calculate and plot a dissimilarity matrix from preprocessed data"""
     # Only use raw data for calculating dissimilarity
     logger.info('Restricting to only raw data for plotting')
-    df_raw = df[[col for col in df.columns if '_raw' in col]].copy()
+    df_raw = df[[col for col in df.columns if '_raw' in col]]
 
     # Find 10,000 most variable CpGs, then use these to calculate dissimilarity
-    df_raw['variance'] = df_raw.var(axis=1)
-
-    df_sorted = df_raw.sort_values(by='variance', ascending=False)
-    df_sorted.drop(columns='variance', inplace=True)
+    df_sorted = df_raw.loc[impute.top_variable(df_raw, 10000)]
     df_sorted.reset_index(drop=True, inplace=True)
-    df_sorted = df_sorted.head(10000)
+
+    # Only fill in missing data for the CpGs actually used
+    df_sorted = impute.impute(df_sorted, impute_method, n_neighbors)
 
     logger.info('Calculating dissimilarity matrix')
     mat = calculate_dissimilarity_matrix(df_sorted)
@@ -2,15 +2,18 @@ import sys
 import os
 
 import matplotlib.pyplot as plt
-from sklearn.decomposition import PCA
 import pandas as pd
 
 import project_logger
+import impute
 
 logger = project_logger.create_logger('pca')
 
 def run_pca(x):
     """Run PCA on data"""
+    # sklearn is slow to import, so defer its import until PCA is actually run
+    from sklearn.decomposition import PCA
+
     # Transpose for finding PCA of samples, not CpGs
     transpose = x.transpose()
 
@@ -67,11 +70,18 @@ def make_plot(df, var, keys, cols, title, xlab, ylab, figname):
 
     return None
 
-def main(df, meta):
+def main(df, meta, impute_method='mean', n_neighbors=5, n_top=10000):
     """Main function to generate principal component analysis"""
     # Only use scaled data for calculating PCA
     logger.info('Restricting to only scaled data for PCA')
-    df_scaled = df[[col for col in df.columns if '_scaled' in col]].copy()
+    df_scaled = df[[col for col in df.columns if '_scaled' in col]]
+
+    # PCA needs complete data. To avoid a filled copy of every CpG, only the n_top most variable CpGs are imputed and
+    # used for PCA when data is missing, otherwise all CpGs are used
+    if df_scaled.count().sum() < df_scaled.size:
+        logger.info(f'Missing data found, restricting to the {n_top} most variable CpGs for PCA')
+        df_scaled = df_scaled.loc[impute.top_variable(df_scaled, n_top)]
+        df_scaled = impute.impute(df_scaled, impute_method, n_neighbors)
 
     var_ratio, pcs = run_pca(df_scaled)
 
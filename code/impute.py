@@ -0,0 +1,70 @@
+import pandas as pd
+import numpy as np
+
+import project_logger
+
+logger = project_logger.create_logger('impute')
+
+def top_variable(df, n_top):
+    """Index of the n_top CpGs with the highest variance across samples, most variable first
+
+    Variance is calculated as if missing values were filled with the CpG mean, which shrinks the variance of CpGs found
+    in only a few samples, so they do not crowd out well covered CpGs. With no missing data, this is the usual variance.
+    """
+    n_seen = df.count(axis=1)
+
+    # Mean filled values add nothing to the sum of squares, only to the number of samples it is divided by
+    variance = df.var(axis=1).fillna(0.0) * (n_seen - 1) / max(len(df.columns) - 1, 1)
+
+    return variance.nlargest(n_top).index
+
+def impute_row_mean(df, missing):
+    """Replace missing values with the mean of the CpG across the samples it was found in"""
+    # missing is the boolean array of missing values, computed once by impute() and reused here
+    means = df.mean(axis=1).to_numpy()
+
+    out = df.to_numpy(copy=True)
+    rows, cols = np.nonzero(missing)
+    out[rows, cols] = means[rows]
+
+    return pd.DataFrame(out, index=df.index, columns=df.columns)
+
+def impute_knn(df, missing, n_neighbors, n_top):
+    """Impute missing values from the nearest samples, only using KNN for the most variable CpGs
+
+    CpGs outside of the n_top most variable are imputed with the CpG mean, as KNN over all CpGs is too slow
+    """
+    # sklearn is slow to import, so defer its import until KNN imputation is actually run
+    from sklearn.impute import KNNImputer
+
+    top = top_variable(df, n_top)
+
+    out = impute_row_mean(df, missing)
+
+    # Samples are the observations and CpGs the features when finding neighbors
+    imputer = KNNImputer(n_neighbors=n_neighbors)
+    out.loc[top] = imputer.fit_transform(df.loc[top].T).T
+
+    return out
+
+def impute(df, method='mean', n_neighbors=5, n_top=10000):
+    """Impute missing values in CpG x sample DataFrame
+
+    Inputs -
+        df          - DataFrame with CpGs as rows and samples as columns, missing values are NaN
+        method      - 'mean' (CpG mean across samples) or 'knn' (nearest samples for most variable CpGs)
+        n_neighbors - number of neighboring samples used for KNN imputation
+        n_top       - number of most variable CpGs used for KNN imputation
+    Returns -
+        DataFrame with missing values filled (df itself if nothing is missing)
+    """
+    missing = df.isna().to_numpy()
+    n_missing = missing.sum()
+    if n_missing == 0:
+        return df
+
+    logger.info(f'Imputing {n_missing} missing values using method: {method}')
+    if method == 'mean':
+        return impute_row_mean(df, missing)
+
+    return impute_knn(df, missing, n_neighbors, n_top)
@@ -1,17 +1,27 @@
 import argparse
 import os
-
-import pandas as pd
+import sys
 
 import project_logger
 import A_read_config as read_config
-import B_preprocess_data as preprocess_data
-import C_descriptive_stats as descriptive_stats
-import D_dissimilarity as dissimilarity
-import E_pca as pca
 
 logger = project_logger.create_logger('main')
 
+# Stage modules (and the pandas/matplotlib/sklearn/scipy imports they pull in) are imported inside the functions that
+# need them, so each subcommand only pays the import cost of the stages it actually runs
+
+def parse_shard(value):
+    """Parse shard given as K/N (shard K of N, 1-based) into a (K, N) tuple"""
+    try:
+        k, n = (int(x) for x in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'shard must be given as K/N, got: {value}')
+
+    if n < 1 or not 1 <= k <= n:
+        raise argparse.ArgumentTypeError(f'shard K/N requires 1 <= K <= N, got: {value}')
+
+    return k, n
+
 def parse_args():
     """Parse command line options"""
     parser = argparse.ArgumentParser(
@@ -21,11 +31,85 @@ def parse_args():
 
     parser.add_argument('-c', '--config', default='config.toml', help='name of TOML config file')
 
-    return parser.parse_args()
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    prep = subparsers.add_parser('preprocess', help='(re)create preprocessed data file')
+    prep.add_argument('--shard', type=parse_shard, help='only process shard K of N (K/N) into a partial file')
+    prep.add_argument(
+        '--shard-by',
+        choices=['sample', 'chr'],
+        help='split shards by sample (default) or chromosome, requires --shard'
+    )
+    prep.add_argument('-o', '--output', help='output file (default: preprocessed_file, suffixed with shard if sharded)')
+
+    merge = subparsers.add_parser('merge', help='merge partial preprocessed files from sharded runs')
+    merge.add_argument('partials', nargs='+', help='partial preprocessed files to merge')
+    merge.add_argument('-o', '--output', help='output file (default: preprocessed_file)')
+
+    subparsers.add_parser('stats', help='plot descriptive statistics')
+    subparsers.add_parser('dissim', help='plot dissimilarity matrix')
+    subparsers.add_parser('pca', help='plot principal component analysis')
+    subparsers.add_parser('all', help='run whole pipeline (default)')
+
+    args = parser.parse_args()
+
+    if args.command == 'preprocess':
+        if args.shard_by is not None and args.shard is None:
+            parser.error('--shard-by requires --shard')
+        if args.shard_by is None:
+            args.shard_by = 'sample'
+
+    # Keep `python main.py` (no subcommand) running the whole pipeline
+    if args.command is None:
+        args.command = 'all'
+
+    return args
+
+def shard_file_name(fname, shard, shard_by):
+    """Name of partial preprocessed file for a shard, e.g., data.tsv -> data.chr-1-of-4.tsv"""
+    k, n = shard
+    root, ext = os.path.splitext(fname)
+
+    return f'{root}.{shard_by}-{k}-of-{n}{ext}'
+
+def preprocess(conf, shard=None, shard_by='sample', oname=None):
+    """Preprocess BED files, writing the preprocessed (or partial) file if one is configured"""
+    import B_preprocess_data as preprocess_data
+
+    if oname is None:
+        oname = conf['preprocessed_file']
+        if shard is not None:
+            if len(oname) == 0:
+                logger.error('Sharded preprocessing needs an output file: set preprocessed_file or use --output')
+                sys.exit(1)
+            oname = shard_file_name(oname, shard, shard_by)
+
+    return preprocess_data.main(
+        conf['data_dir'],
+        conf['n_processes'],
+        conf['meta_file'],
+        oname,
+        shard,
+        shard_by,
+        conf['min_sample_fraction']
+    )
+
+def merge(conf, partials, oname=None):
+    """Merge partial preprocessed files into the preprocessed file"""
+    import B_preprocess_data as preprocess_data
+
+    if oname is None:
+        oname = conf['preprocessed_file']
+        if len(oname) == 0:
+            logger.error('Merging needs an output file: set preprocessed_file or use --output')
+            sys.exit(1)
+
+    return preprocess_data.merge(partials, oname, conf['min_sample_fraction'])
 
 def get_data(conf):
     """Read preprocessed TSV if available, otherwise create"""
     if os.path.exists(conf['preprocessed_file']):
+        import pandas as pd
+
         logger.info(f'Using existing preprocessed file: {conf["preprocessed_file"]}')
         return pd.read_csv(
             conf['preprocessed_file'],
@@ -34,12 +118,45 @@ def get_data(conf):
         )
 
     logger.info('Cannot determine if data has been preprocessed - preprocessing now')
-    return preprocess_data.main(
-        conf['data_dir'],
-        conf['n_processes'],
-        conf['meta_file'],
-        conf['preprocessed_file']
-    )
+    return preprocess(conf)
+
+def get_metadata(conf):
+    """Read metadata TSV file"""
+    import pandas as pd
+
+    return pd.read_csv(conf['meta_file'], sep='\t')
+
+def run_stats(conf, df):
+    """Descriptive statistics stage"""
+    import C_descriptive_stats as descriptive_stats
+
+    descriptive_stats.main(df)
+
+    return None
+
+def run_dissim(conf, df):
+    """Dissimilarity matrix stage"""
+    import D_dissimilarity as dissimilarity
+
+    dissimilarity.main(df, conf['impute_method'], conf['knn_neighbors'])
+
+    return None
+
+def run_pca(conf, df):
+    """Principal component analysis stage"""
+    import E_pca as pca
+
+    pca.main(df, get_metadata(conf), conf['impute_method'], conf['knn_neighbors'], conf['pca_n_top'])
+
+    return None
+
+# Analysis stages run by each subcommand, in pipeline order
+STAGES = {
+    'stats': [run_stats],
+    'dissim': [run_dissim],
+    'pca': [run_pca],
+    'all': [run_stats, run_dissim, run_pca],
+}
 
 def main():
     """Main entry point for program"""
@@ -49,16 +166,20 @@ def main():
     # Run time configuration
     conf = read_config.read_config(args.config)
 
+    if args.command == 'preprocess':
+        preprocess(conf, args.shard, args.shard_by, args.output)
+        return None
+
+    if args.command == 'merge':
+        merge(conf, args.partials, args.output)
+        return None
+
     # Read and preprocess data
     df = get_data(conf)
 
-    # Setup metadata DataFrame
-    meta = pd.read_csv(conf['meta_file'], sep='\t')
-
     # Do analysis and visualization portions of pipeline
-    descriptive_stats.main(df)
-    dissimilarity.main(df)
-    pca.main(df, meta)
+    for stage in STAGES[args.command]:
+        stage(conf, df)
 
     return None
 